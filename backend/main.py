@@ -1,39 +1,221 @@
 # backend/main.py
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-import os, uuid, shutil, json
-from backend.pipeline import run_pipeline
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import Response
+import os, io, uuid, asyncio, gzip, mmap, shutil, logging
+from contextlib import asynccontextmanager
+import orjson
+import blake3
+from concurrent.futures import ThreadPoolExecutor
+from backend.pipeline import run_pipeline, load_pcm, transcribe_many, warmup, model_loaded, ensure_dir, NUM_WORKERS
 
 
-app = FastAPI(title="OHCR Backend")
+log = logging.getLogger("ohcr")
+
+@asynccontextmanager
+async def lifespan(app):
+    # the queue and event bind to the running loop, so each app lifecycle gets fresh ones
+    global _QUEUE, _READY
+    _QUEUE, _READY = asyncio.Queue(), asyncio.Event()
+    # load and warm up Whisper in the background, so uvicorn binds the port right away
+    # instead of after the model download; /api/ready reports when it is done
+    _WARMUP["error"] = None
+    _WARMUP["task"] = asyncio.create_task(_warmup_in_background())
+    # one batcher per worker so up to NUM_WORKERS batches run at once
+    for _ in range(NUM_WORKERS):
+        _start_batcher()
+    yield
+    tasks = [_WARMUP["task"], *_BATCHERS]
+    _BATCHERS.clear()  # before cancelling, so the done-callback doesn't restart them
+    for t in tasks: t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+app = FastAPI(title="OHCR Backend", lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], allow_methods=["*"], allow_headers=["*"],
 )
+app.add_middleware(GZipMiddleware, minimum_size=1024)  # utterance lists are large, repetitive JSON
 
 BASE_DIR = os.path.dirname(__file__)
 UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
 RESULTS_DIR = os.path.join(BASE_DIR, "results")
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-os.makedirs(RESULTS_DIR, exist_ok=True)
+ensure_dir(UPLOAD_DIR)  # created once at import, never per request
+ensure_dir(RESULTS_DIR)
+
+COPY_CHUNK = 4 * 1024 * 1024  # copy buffer for in-memory uploads; the 16 KiB default is ~64k syscalls/GB
+
+# transcription blocks for minutes; keep it off the event loop, bounded by NUM_WORKERS
+_EXEC = ThreadPoolExecutor(max_workers=NUM_WORKERS)
+
+# uploads arriving within BATCH_WINDOW_S of each other share one batched transcription
+BATCH_WINDOW_S = 0.1
+MAX_BATCH = int(os.environ.get("OHCR_MAX_BATCH", "4"))
+_QUEUE: "asyncio.Queue[tuple]" = None  # (audio_path, future); created per lifespan
+_BATCHERS = []  # keep references so the worker tasks are not garbage-collected
+_INFLIGHT = {}  # session_id -> future of the summary being computed for it
+_READY: asyncio.Event = None  # set once the background warmup has finished (or failed)
+_WARMUP = {"task": None, "error": None}
+
+def _load_json(path: str):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f: return orjson.loads(f.read())
+
+def _persist_upload(src, dest: str) -> str:
+    """Save a spooled upload to dest and return its BLAKE3 hex digest.
+
+    Starlette spools uploads over 1 MB to an anonymous temp file. Those bytes are
+    copied in-kernel with os.sendfile where the platform allows file-to-file
+    sendfile (Linux), else in COPY_CHUNK pieces, and hashed from an mmap.
+    Uploads still held in memory are copied in COPY_CHUNK pieces.
+    """
+    raw = getattr(src, "_file", src)  # SpooledTemporaryFile wraps a BytesIO or a real file
+    if isinstance(raw, io.BytesIO) or not hasattr(raw, "fileno"):
+        src.seek(0)
+        digest = blake3.blake3()
+        with open(dest, "wb") as f:
+            while chunk := src.read(COPY_CHUNK):
+                digest.update(chunk)
+                f.write(chunk)
+        return digest.hexdigest()
+
+    raw.flush()
+    fd = raw.fileno()
+    size = os.fstat(fd).st_size
+    with open(dest, "wb") as out:
+        offset = 0
+        try:
+            while offset < size:
+                sent = os.sendfile(out.fileno(), fd, offset, size - offset)
+                if not sent: break
+                offset += sent
+        except (OSError, AttributeError):  # macOS wants a socket as out fd; Windows has no sendfile
+            raw.seek(offset)
+            shutil.copyfileobj(raw, out, COPY_CHUNK)
+    if not size:
+        return blake3.blake3().hexdigest()
+    with mmap.mmap(fd, size, access=mmap.ACCESS_READ) as m:
+        return blake3.blake3(m, max_threads=blake3.blake3.AUTO).hexdigest()
+
+async def _batch_worker():
+    """Collect queued uploads for up to BATCH_WINDOW_S (max MAX_BATCH) and transcribe them together."""
+    loop = asyncio.get_running_loop()
+    await _READY.wait()  # don't race the warmup thread to load the model
+    while True:
+        jobs = [await _QUEUE.get()]
+        deadline = loop.time() + BATCH_WINDOW_S
+        while len(jobs) < MAX_BATCH and (left := deadline - loop.time()) > 0:
+            try:
+                jobs.append(await asyncio.wait_for(_QUEUE.get(), left))
+            except asyncio.TimeoutError:
+                break
+        # decode each file on its own so one unreadable upload only fails its own request
+        pcms, futs = [], []
+        for path, fut in jobs:
+            try:
+                pcms.append(await loop.run_in_executor(_EXEC, load_pcm, path))
+                futs.append(fut)
+            except Exception as e:
+                if not fut.done(): fut.set_exception(e)
+        del jobs
+        if not pcms:
+            continue
+        try:
+            results = await loop.run_in_executor(_EXEC, transcribe_many, pcms)
+        except Exception as e:
+            for fut in futs:
+                if not fut.done(): fut.set_exception(e)
+        else:
+            for fut, words in zip(futs, results):
+                if not fut.done(): fut.set_result(words)
+
+async def _transcribe_queued(audio_path: str):
+    fut = asyncio.get_running_loop().create_future()
+    await _QUEUE.put((audio_path, fut))
+    return await fut
+
+def _start_batcher():
+    task = asyncio.create_task(_batch_worker())
+    task.add_done_callback(_batcher_done)
+    _BATCHERS.append(task)
+
+def _batcher_done(task):
+    # a batcher that dies would leave queued uploads waiting forever, so replace it
+    if task not in _BATCHERS:  # shut down by the lifespan
+        return
+    _BATCHERS.remove(task)
+    if task.cancelled():
+        log.warning("transcription batcher was cancelled; restarting it")
+    else:
+        log.error("transcription batcher died; restarting it", exc_info=task.exception())
+    _start_batcher()
+
+async def _warmup_in_background():
+    try:
+        await asyncio.to_thread(warmup)
+    except Exception as e:  # uploads will retry the load and report the error themselves
+        _WARMUP["error"] = repr(e)
+    finally:
+        _READY.set()
+
+_HEALTH = Response(b'{"ok":true}', media_type="application/json")  # built once; probes hit this a lot
 
 @app.get("/api/health")
 def health():
-    return {"ok": True}
+    return _HEALTH
+
+@app.get("/api/ready")
+def ready():
+    if not _READY.is_set():
+        raise HTTPException(503, "Model is warming up.")
+    # follow the model itself: an upload may load it after a failed warmup
+    if not model_loaded() and _WARMUP["error"]:
+        raise HTTPException(503, f"Model warmup failed: {_WARMUP['error']}")
+    return _HEALTH
 
 @app.post("/api/upload")
 async def upload(file: UploadFile = File(...)):
     # save file to disk
     if not file.filename.lower().endswith(".mp3"):
         raise HTTPException(status_code=400, detail="Please upload an .mp3 file")
-    session_id = uuid.uuid4().hex[:8]
-    sess_upload = os.path.join(UPLOAD_DIR, f"{session_id}.mp3")
-    with open(sess_upload, "wb") as f:
-        shutil.copyfileobj(file.file, f)
+    part = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}.part")
+    loop = asyncio.get_running_loop()
+    try:
+        digest = await loop.run_in_executor(None, _persist_upload, file.file, part)
+    except BaseException:  # e.g. disk full: don't leave the partial copy behind
+        try: os.remove(part)
+        except OSError: pass
+        raise
 
-    # run pipeline (synchronous for MVP; later we’ll async/queue this)
+    # same bytes -> same analysis, so the content hash is the session id;
+    # a re-upload of a finished file returns its stored summary
+    session_id = digest[:16]
     out_dir = os.path.join(RESULTS_DIR, session_id)
-    summary = run_pipeline(sess_upload, out_dir)
+    summ_path = os.path.join(out_dir, "summary.json")
+    if os.path.exists(summ_path):
+        os.remove(part)
+        return {"session_id": session_id, "summary": _load_json(summ_path)}
+    # the same bytes already being analysed (e.g. a double submit): wait for that run
+    if session_id in _INFLIGHT:
+        os.remove(part)
+        return {"session_id": session_id, "summary": await asyncio.shield(_INFLIGHT[session_id])}
+    fut = _INFLIGHT[session_id] = loop.create_future()
+    fut.add_done_callback(lambda f: f.cancelled() or f.exception())  # fine if no duplicate ever awaits it
+    try:
+        sess_upload = os.path.join(UPLOAD_DIR, f"{session_id}.mp3")
+        os.replace(part, sess_upload)
+
+        # transcribe via the batch queue, then analyse off the event loop (fast, no worker slot needed)
+        words = await _transcribe_queued(sess_upload)
+        summary = await loop.run_in_executor(None, run_pipeline, sess_upload, out_dir, words)
+        fut.set_result(summary)
+    except BaseException as e:
+        if isinstance(e, asyncio.CancelledError): fut.cancel()
+        else: fut.set_exception(e)
+        raise
+    finally:
+        del _INFLIGHT[session_id]
 
     return {"session_id": session_id, "summary": summary}
 
@@ -41,9 +223,9 @@ async def upload(file: UploadFile = File(...)):
 def get_results(session_id: str):
     out_dir = os.path.join(RESULTS_DIR, session_id)
     summ_path = os.path.join(out_dir, "summary.json")
-    utt_path = os.path.join(out_dir, "utterances.json")
+    utt_path = os.path.join(out_dir, "utterances.json.gz")
     if not os.path.exists(summ_path):
         raise HTTPException(404, "Not found.")
-    with open(summ_path) as f: summary = json.load(f)
-    with open(utt_path) as f: utts = json.load(f)
-    return {"summary": summary, "utterances": utts}
+    if not os.path.exists(utt_path):  # sessions stored before artifacts were gzipped
+        utt_path = utt_path[:-3]
+    return {"summary": _load_json(summ_path), "utterances": _load_json(utt_path)}
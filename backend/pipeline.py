@@ -1,108 +1,363 @@
 # backend/pipeline.py
 """
 This file runs the analysis pipeline:
-- Transcribe MP3 using open-source Whisper (local, no API keys)
+- Transcribe MP3 using faster-whisper (CTranslate2 Whisper, local, no API keys)
 - Segment into utterances
 - Tag discourse acts (Question / Statement / Regulatory)
 - Infer roles (teacher/student) with simple heuristics
 - Label OHCR (Observe/Hypothesize/Challenge/Resolve) using cues
 - Compute metrics + feedback tips
-Outputs JSON files in backend/results/{session_id}/
+Outputs JSON files in backend/results/{session_id}/ (large ones gzipped)
 """
 
-import os, json, re, uuid
-from typing import List, Dict
-import whisper
+import os, re, uuid, gzip, bisect, threading
+from operator import itemgetter
+from typing import List, Dict, Optional, Tuple, Union
+import ahocorasick
+import ctranslate2
+import numpy as np
+import orjson
+from faster_whisper import BatchedInferencePipeline, WhisperModel, decode_audio
+from faster_whisper.vad import VadOptions, get_speech_timestamps
 
 PAUSE_S = 0.6  # utterance boundary if gap between segments exceeds this
+NUM_WORKERS = int(os.environ.get("OHCR_WORKERS", "1"))  # pipelines allowed to run at once
+COMPUTE_TYPE = os.environ.get("OHCR_COMPUTE_TYPE")  # override precision, e.g. "float16"
+BATCH_SIZE = int(os.environ.get("OHCR_BATCH_SIZE", "16"))  # 30 s speech windows per forward pass
+SAMPLE_RATE = 16000  # Whisper and Silero VAD both consume 16 kHz mono float32
+CHUNK_S = 30  # Whisper's native window; VAD speech is merged up to this length
+MAX_REPEATS = 3  # a 3–6 word phrase repeated back-to-back more often than this is a decoding loop
+# whole segments Whisper hallucinates from its YouTube training data
+BOILERPLATE = frozenset(("thanks for watching","thank you for watching","thank you so much for watching",
+                         "please subscribe","subscribe","like and subscribe","subscribe to my channel",
+                         "subtitles by the amaraorg community"))
+_PUNCT_RE = re.compile(r"[^\w\s]")
+
+_MODEL = None  # loaded once per process, see get_model()
+_PIPE = None
+_LOAD_LOCK = threading.Lock()  # warmup and worker threads may ask for the model at once
+
+# fastest precision first: int8 weights with fp16/bf16 activations on GPU, int8 on CPU
+_PRECISIONS = {"cuda": ("int8_float16", "int8_bfloat16", "float16", "bfloat16"),
+               "cpu": ("int8", "int8_float32")}
+
+def _compute_type(device: str) -> str:
+    """Pick the first preferred precision this device supports (older GPUs lack int8/bf16)."""
+    supported = ctranslate2.get_supported_compute_types(device)
+    return next((c for c in _PRECISIONS[device] if c in supported), "float32")
+
+def get_model() -> WhisperModel:
+    """Return the shared Whisper model, loading it on first use."""
+    global _MODEL
+    if _MODEL is None:
+        with _LOAD_LOCK:
+            if _MODEL is None:
+                device = "cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu"
+                _MODEL = WhisperModel("small", device=device, compute_type=COMPUTE_TYPE or _compute_type(device),
+                                      num_workers=NUM_WORKERS)
+    return _MODEL
+
+def get_pipeline() -> BatchedInferencePipeline:
+    """Return the shared batched pipeline (Silero VAD + chunked batch decoding) over get_model()."""
+    global _PIPE
+    if _PIPE is None:
+        model = get_model()  # outside the lock: it takes the lock itself
+        with _LOAD_LOCK:
+            if _PIPE is None:
+                _PIPE = BatchedInferencePipeline(model=model)
+    return _PIPE
+
+def model_loaded() -> bool:
+    """True once get_pipeline() has loaded the model, by warmup or by a later upload."""
+    return _PIPE is not None
+
+def warmup() -> None:
+    """Decode one silent 30 s window so kernel selection and buffer allocation happen at startup.
+
+    Every window is padded to the same 3000-frame shape, so later calls reuse this setup.
+    """
+    silence = np.zeros(SAMPLE_RATE * CHUNK_S, dtype=np.float32)
+    segs, _ = get_pipeline().transcribe(silence, beam_size=1, vad_filter=False,
+                                        clip_timestamps=[{"start": 0, "end": CHUNK_S}])
+    list(segs)  # segments are generated lazily
+
+_DIR_CACHE = set()  # long-lived directories this process already created
 
 def ensure_dir(path: str):
+    """makedirs once per path; repeat calls skip the per-component stat()s.
+
+    Only for directories that live as long as the process (uploads/, results/);
+    per-session dirs can be deleted underneath us, so they use os.makedirs directly.
+    """
+    if path in _DIR_CACHE: return
     os.makedirs(path, exist_ok=True)
+    _DIR_CACHE.add(path)
+
+def _dump(path: str, obj) -> None:
+    """Write obj as JSON in a single write (orjson encodes in C); *.gz paths are gzipped, compact.
+
+    Written to a temp file and renamed into place, so readers never see a partial file.
+    """
+    tmp = path + ".tmp"
+    if path.endswith(".gz"):
+        with gzip.open(tmp, "wb", compresslevel=6) as f: f.write(orjson.dumps(obj))
+    else:
+        with open(tmp, "wb") as f: f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    os.replace(tmp, path)
+
+def load_pcm(audio_path: str) -> np.ndarray:
+    """Decode and resample audio once to 16 kHz mono float32, shared by VAD and Whisper."""
+    return decode_audio(audio_path, sampling_rate=SAMPLE_RATE)
+
+def transcribe(audio: Union[str, np.ndarray]) -> List[Dict]:
+    """Run Whisper locally and return a list of word/segment-like chunks.
+
+    `audio` is a file path or the array from load_pcm(). Goes through the same
+    windowing as transcribe_many(), so a file transcribes identically alone or batched.
+    """
+    pcm = load_pcm(audio) if isinstance(audio, str) else audio
+    return transcribe_many([pcm])[0]
+
+def _speech_windows(pcm: np.ndarray) -> List[List[Tuple[int, int]]]:
+    """Silero VAD speech regions (sample ranges) packed into windows of at most CHUNK_S seconds of speech.
+
+    Only the speech is kept: the silence between regions is cut out when the
+    window is decoded, as faster-whisper's own vad_filter does.
+    """
+    speech = get_speech_timestamps(pcm, VadOptions(max_speech_duration_s=CHUNK_S, min_silence_duration_ms=160),
+                                   sampling_rate=SAMPLE_RATE)
+    windows, used = [], 0
+    for ts in speech:
+        n = ts["end"] - ts["start"]
+        if windows and used + n <= CHUNK_S * SAMPLE_RATE:
+            windows[-1].append((ts["start"], ts["end"]))
+            used += n
+        else:
+            windows.append([(ts["start"], ts["end"])])
+            used = n
+    return windows
+
+def _detect_language(pcm: np.ndarray, windows: List[List[Tuple[int, int]]]) -> str:
+    """Language of one recording, judged from its first speech window."""
+    model = get_model()
+    if not model.model.is_multilingual:
+        return "en"
+    return model.detect_language(audio=np.concatenate([pcm[a:b] for a, b in windows[0]]))[0]
+
+def _transcribe_joined(pcms: List[np.ndarray], windows: List[List[List[Tuple[int, int]]]],
+                       language: str) -> List[List[Dict]]:
+    """Decode same-language recordings in shared batches; empties `pcms` as it goes.
 
-def transcribe(audio_path: str) -> List[Dict]:
-    """Run Whisper locally and return a list of word/segment-like chunks."""
-    model = whisper.load_model("small")  # try "base"/"medium" depending on speed
-    result = model.transcribe(audio_path, verbose=False)
-    segs = result.get("segments", [])
-    return [{"start": s["start"], "end": s["end"], "text": s["text"].strip()} for s in segs]
+    The speech regions of all recordings are copied end to end into one
+    preallocated buffer (each recording released once copied) and every window
+    passed as a clip timestamp, so a BATCH_SIZE forward pass can mix windows
+    from different files while no window straddles two of them. Segment times
+    are mapped back from the packed buffer to each file and rounded to 3 decimals.
+    """
+    audio = np.empty(sum(b - a for ws in windows for w in ws for a, b in w), dtype=np.float32)
+    starts, pieces, clips = [], [], []  # packed start -> (file, original start) of each speech region
+    pos = 0
+    for k, ws in enumerate(windows):
+        pcm = pcms.pop(0)
+        for w in ws:
+            clip_start = pos
+            for a, b in w:
+                audio[pos:pos+b-a] = pcm[a:b]
+                starts.append(pos); pieces.append((k, a))
+                pos += b - a
+            clips.append({"start": clip_start / SAMPLE_RATE, "end": pos / SAMPLE_RATE})
+        del pcm
+
+    def restore(t: float, side) -> Tuple[int, float]:
+        # a time on a region boundary belongs to the region it starts (side=bisect_right) or ends (bisect_left)
+        n = int(round(t * SAMPLE_RATE))
+        j = max(side(starts, n) - 1, 0)
+        k, orig = pieces[j]
+        return k, (orig + n - starts[j]) / SAMPLE_RATE
+
+    segs, _ = get_pipeline().transcribe(audio, language=language, beam_size=1, batch_size=BATCH_SIZE,
+                                        vad_filter=False, clip_timestamps=clips,
+                                        condition_on_previous_text=False)
+    out = [[] for _ in windows]
+    for s in segs:
+        if _is_boilerplate(s.text):
+            continue
+        k, _ = restore((s.start + s.end) / 2, bisect.bisect_right)  # midpoint: robust to rounding
+        ks, start = restore(s.start, bisect.bisect_right)
+        ke, end = restore(s.end, bisect.bisect_left)
+        if ks != k: start = 0.0  # only possible through rounding at a file boundary
+        if ke != k: end = start
+        out[k].append({"start": round(start, 3), "end": round(end, 3), "text": s.text.strip()})
+    return out
+
+def transcribe_many(pcms: List[np.ndarray]) -> List[List[Dict]]:
+    """Transcribe several recordings; returns one segment list per recording and empties `pcms`.
+
+    Each recording's language is detected on its own, then recordings sharing a
+    language are decoded together by _transcribe_joined().
+    """
+    windows = [_speech_windows(p) for p in pcms]
+    groups = {}  # language -> indices of recordings with speech
+    for i, ws in enumerate(windows):
+        if ws:
+            groups.setdefault(_detect_language(pcms[i], ws), []).append(i)
+    # from here on only `held` (then each group) references the audio; silent files are dropped
+    held = [p if ws else None for p, ws in zip(pcms, windows)]
+    pcms.clear()
+    out = [[] for _ in windows]
+    for language, idx in groups.items():
+        group = []
+        for i in idx:
+            group.append(held[i]); held[i] = None
+        for i, segs in zip(idx, _transcribe_joined(group, [windows[i] for i in idx], language)):
+            out[i] = segs
+    return out
+
+def _is_boilerplate(text: str) -> bool:
+    return _PUNCT_RE.sub("", text.lower()).strip() in BOILERPLATE
+
+def _repeat_at(tokens: List[str], i: int):
+    """Return (n, reps) if an n-gram (n=3..6) starting at i repeats > MAX_REPEATS times in a row."""
+    for n in range(3, 7):
+        gram = tokens[i:i+n]
+        if len(gram) < n:
+            return None
+        reps = 1
+        while tokens[i+reps*n:i+(reps+1)*n] == gram:
+            reps += 1
+        if reps > MAX_REPEATS:
+            return n, reps
+    return None
+
+def _dedup(text: str) -> str:
+    """Collapse Whisper repetition loops, keeping one copy of the looping phrase."""
+    tokens = text.split()
+    if len(tokens) <= 3 * MAX_REPEATS:
+        return text
+    out, i, looped = [], 0, False
+    while i < len(tokens):
+        hit = _repeat_at(tokens, i)
+        if hit:
+            n, reps = hit
+            out.extend(tokens[i:i+n]); i += n * reps; looped = True
+        else:
+            out.append(tokens[i]); i += 1
+    return " ".join(out) if looped else text
+
+def scrub_repetitions(utterances: List[Dict]) -> None:
+    """Remove repetition loops from utterance text (loops often span several segments)."""
+    for u in utterances:
+        u["text"] = _dedup(u["text"])
 
 def segment_utterances(words: List[Dict]) -> List[Dict]:
     """Merge close segments into utterances based on pause threshold."""
     if not words: return []
-    utterances, cur = [], {"t_start": words[0]["start"], "t_end": words[0]["end"], "text": words[0]["text"]}
-    for w in words[1:]:
-        gap = w["start"] - cur["t_end"]
-        if gap > PAUSE_S:
-            utterances.append(cur)
-            cur = {"t_start": w["start"], "t_end": w["end"], "text": w["text"]}
-        else:
-            cur["t_end"] = w["end"]
-            cur["text"] += " " + w["text"]
-    utterances.append(cur)
-    # Add IDs and duration
-    for i, u in enumerate(utterances):
-        u["u_id"] = i
-        u["duration"] = u["t_end"] - u["t_start"]
+    # one C-level pass pulls the three fields into tuples; the loops below only touch locals
+    starts, ends, texts = zip(*map(itemgetter("start", "end", "text"), words))
+    # a new utterance begins wherever the gap after the previous segment exceeds PAUSE_S
+    gaps = np.asarray(starts[1:], dtype=np.float64) - np.asarray(ends[:-1], dtype=np.float64)
+    bounds = [0, *(np.flatnonzero(gaps > PAUSE_S) + 1).tolist(), len(words)]
+    utterances = []
+    append = utterances.append
+    for i, (a, b) in enumerate(zip(bounds, bounds[1:])):
+        t_start, t_end = starts[a], ends[b-1]
+        append({"t_start": t_start, "t_end": t_end, "text": " ".join(texts[a:b]),
+                "u_id": i, "duration": t_end - t_start})
     return utterances
 
 QUESTION_RE = re.compile(r"(who|what|why|how|when|where|do|does|did|can|could|would|should|is|are|will)\b.*\?$", re.I)
 REG_HINTS = ("open your","submit","turn to","raise your","deadline","attendance")
+TEACHER_HINTS = ("welcome","today","let’s","now","observe","look at","see this")
+STUDENT_HINTS = ("i think","maybe","could be","because","i feel","i guess")
+O_CUES = ("observe","look at","consider","example","video","see this")
+H_CUES = ("maybe","i think","could be","because","suppose","if we")
+C_CUES = ("but does","what if","how do we","does that hold","is it always","however","not always")
+R_CUES = ("so","therefore","we can say","this means","by definition","in summary")
+LEVEL5_CUES = ("therefore","apply")
 
-def tag_acts(utterances: List[Dict]) -> None:
-    """Add disc_act: question / statement / regulatory."""
-    for u in utterances:
-        text = u["text"].lower().strip()
-        if any(h in text for h in REG_HINTS):
-            u["disc_act"] = "regulatory"
+# every cue phrase in one Aho-Corasick automaton: a single C-level pass per text finds
+# all cues, each tagged with the categories whose lists contain it
+_CUE_LISTS = {"reg": REG_HINTS, "teacher": TEACHER_HINTS, "student": STUDENT_HINTS,
+              "O": O_CUES, "H": H_CUES, "C": C_CUES, "R": R_CUES, "L5": LEVEL5_CUES}
+_CUES = ahocorasick.Automaton()
+for _phrase in {p for phrases in _CUE_LISTS.values() for p in phrases}:
+    _CUES.add_word(_phrase, frozenset(c for c, phrases in _CUE_LISTS.items() if _phrase in phrases))
+_CUES.make_automaton()
+_OHCR_SET = frozenset("OHCR")
+
+def _cues(text: str) -> set:
+    """Categories with at least one cue phrase in (lowercased) text."""
+    found = set()
+    for _, cats in _CUES.iter(text):
+        found |= cats
+    return found
+
+def classify(texts_lower: List[str]) -> Tuple[List[str], List[str], List[str], List[bool]]:
+    """One fused walk over lowercased texts -> (disc_act, role, ohcr, level5) columns."""
+    acts, roles, ohcr, level5 = [], [], [], []
+    for i, text in enumerate(texts_lower):
+        cues = _cues(text)
+        level5.append("L5" in cues)
+        # discourse act: question / statement / regulatory
+        if "reg" in cues:
+            acts.append("regulatory")
         elif "?" in text or QUESTION_RE.search(text):
-            u["disc_act"] = "question"
+            acts.append("question")
         else:
-            u["disc_act"] = "statement"
-
-def infer_roles(utterances: List[Dict]) -> None:
-    """Very simple teacher/student inference; UI can override in future."""
-    for i, u in enumerate(utterances):
-        t = u["text"].lower()
-        if i == 0 or any(x in t for x in ["welcome", "today", "let’s", "now", "observe", "look at", "see this"]):
-            u["role"] = "teacher"
-        elif any(x in t for x in ["i think", "maybe", "could be", "because", "i feel", "i guess"]) or len(t.split()) < 7:
-            u["role"] = "student"
+            acts.append("statement")
+        # very simple teacher/student inference; UI can override in future
+        if i == 0 or "teacher" in cues:
+            teacher = True
+        elif "student" in cues or len(text.split()) < 7:
+            teacher = False
         else:
-            u["role"] = "teacher"
-
-def label_ohcr(utterances: List[Dict]) -> None:
-    """Rule-based OHCR tagging; safe & explainable baseline."""
-    for u in utterances:
-        text = u["text"].lower()
-        role = u.get("role", "unknown")
-        if role=="teacher" and any(k in text for k in ["observe","look at","consider","example","video","see this"]):
-            u["ohcr"] = "O"
-        elif any(k in text for k in ["maybe","i think","could be","because","suppose","if we"]):
-            u["ohcr"] = "H"
-        elif any(k in text for k in ["but does","what if","how do we","does that hold","is it always","however","not always"]):
-            u["ohcr"] = "C"
-        elif role=="teacher" and any(k in text for k in ["so","therefore","we can say","this means","by definition","in summary"]):
-            u["ohcr"] = "R"
+            teacher = True
+        roles.append("teacher" if teacher else "student")
+        # rule-based OHCR tagging; safe & explainable baseline
+        if teacher and "O" in cues:
+            ohcr.append("O")
+        elif "H" in cues:
+            ohcr.append("H")
+        elif "C" in cues:
+            ohcr.append("C")
+        elif teacher and "R" in cues:
+            ohcr.append("R")
         else:
-            u["ohcr"] = "?"
+            ohcr.append("?")
+    return acts, roles, ohcr, level5
+
+def tag_utterances(utterances: List[Dict]) -> List[bool]:
+    """Add disc_act, role and ohcr via classify(); returns the Level-5 column for compute_metrics."""
+    acts, roles, ohcr, level5 = classify([u["text"].lower().strip() for u in utterances])
+    for u, a, r, o in zip(utterances, acts, roles, ohcr):
+        u["disc_act"], u["role"], u["ohcr"] = a, r, o
+    return level5
 
-def compute_metrics(utterances: List[Dict]) -> Dict:
+def compute_metrics(utterances: List[Dict], level5: Optional[List[bool]] = None) -> Dict:
     """Compute basic metrics including HC-depth, OHCR coverage, Level-5 proxy, KC score."""
     n = len(utterances) or 1
-    # OHCR coverage
-    ohcr_idx = sum(u["ohcr"] in ["O","H","C","R"] for u in utterances) / n
-    # HC-depth (count H/C alternations until each R)
+    if level5 is None:
+        level5 = ["L5" in _cues(u["text"].lower()) for u in utterances]
+    # one pass: OHCR coverage, HC-depth (H/C alternations until each R), student turns,
+    # simple Level-5 proxy (R near confirmations/application, very naive)
+    ohcr_hits = student_hits = level5_hits = 0
     depths, d = [], 0
-    for u in utterances:
-        if u["ohcr"] in ["H","C"]: d += 1
-        if u["ohcr"] == "R":
-            depths.append(d//2); d = 0
+    for u, l5 in zip(utterances, level5):
+        lbl = u["ohcr"]
+        if lbl in _OHCR_SET:
+            ohcr_hits += 1
+            if lbl == "H" or lbl == "C":
+                d += 1
+            elif lbl == "R":
+                depths.append(d//2); d = 0
+        if u.get("role") == "student":
+            student_hits += 1
+        if l5:
+            level5_hits += 1
+    ohcr_idx = ohcr_hits / n
     avg_hc = sum(depths)/len(depths) if depths else 0
     max_hc = max(depths) if depths else 0
-    # student talk %
-    student_talk_pct = sum(u.get("role")=="student" for u in utterances)/n
-    # simple Level-5 proxy: presence of R near confirmations/application (very naive)
-    level5_hits = sum(("therefore" in u["text"].lower() or "apply" in u["text"].lower()) for u in utterances)
+    student_talk_pct = student_hits / n
     level5_pct = level5_hits / n
     # KC composite (0–1)
     kc = 0.25*ohcr_idx + 0.25*(avg_hc/3) + 0.25*student_talk_pct + 0.25*level5_pct
@@ -184,23 +439,26 @@ def prescriptions_from(metrics):
 
     return cards
 
-def run_pipeline(audio_path: str, out_dir: str) -> Dict:
-    """Main entry — runs everything and writes JSON artifacts."""
-    ensure_dir(out_dir)
-    words = transcribe(audio_path)
-    with open(os.path.join(out_dir, "words.json"), "w") as f: json.dump(words,f,indent=2)
+def run_pipeline(audio_path: str, out_dir: str, words: Optional[List[Dict]] = None) -> Dict:
+    """Main entry — runs everything and writes JSON artifacts.
+
+    Pass `words` (e.g. from transcribe_many) to skip transcription.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    if words is None:
+        words = transcribe(load_pcm(audio_path))
+    _dump(os.path.join(out_dir, "words.json.gz"), words)
 
     utts = segment_utterances(words)
-    tag_acts(utts)
-    infer_roles(utts)
-    label_ohcr(utts)
-    with open(os.path.join(out_dir, "utterances.json"), "w") as f: json.dump(utts,f,indent=2)
+    scrub_repetitions(utts)
+    level5 = tag_utterances(utts)
+    _dump(os.path.join(out_dir, "utterances.json.gz"), utts)
 
-    metrics = compute_metrics(utts)
-    with open(os.path.join(out_dir, "metrics.json"), "w") as f: json.dump(metrics,f,indent=2)
+    metrics = compute_metrics(utts, level5)  # stored inside summary.json
 
     cards = prescriptions_from(metrics)
     summary = {"metrics": metrics, "feedback": cards}
-    with open(os.path.join(out_dir, "summary.json"), "w") as f: json.dump(summary,f,indent=2)
+    # summary.json stays plain: it is small and read on every results request
+    _dump(os.path.join(out_dir, "summary.json"), summary)
 
     return summary